@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# Benchmarks the classification of the activity headings on the entry_content
+# of the activity pages, one for each language in resources.json, kept in
+# fixtures/activities, and lists the activity nodes built from each page.
+#
+#     ./bench_activities.py --repeat 20
+#     ./bench_activities.py --record
+
+import argparse
+from collections import Counter
+import json
+import os
+import sys
+import time
+
+from bs4 import BeautifulSoup
+import sushichef
+from utils import build_path, file_exists, normalize_heading
+
+
+RECORDED_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "fixtures", "activities")
+
+# the lists that were hard coded in Activities.to_file
+LEGACY_HEADINGS = dict(
+    language=["LANGUAGE ACTIVITIES", "Sprachliche Aktivitäten",
+        "ATTIVITÀ LINGUISTICHE", "KIELITEHTÄVÄT", "ACTIVITĂŢI LINGVISTICE",
+        "DİL AKTİVİTELERİ"],
+    culture=["ACTIVIDADES CULTURALES", "Kulturelle Aktivitäten",
+        "CULTURAL ACTIVITIES", "ATTIVITÀ CULTURALI", "KULTTUURITEHTÄVÄT",
+        "ACTIVITĂŢI CULTURALE", "KÜLTÜREL AKTİVİTELERE"],
+    music=["ACTIVIDADES MUSICALES", "Musikalische Aktivitäten",
+        "MUSICAL ACTIVITIES", "ATTIVITÀ MUSICALI", "MUSIIKKITEHTÄVÄT",
+        "ACTIVITĂŢI MUZICALE", "MÜZİK AKTİVİTELERİ"])
+
+
+def legacy_classify(paragraphs):
+    headings = dict((category, [text.lower() for text in texts])
+        for category, texts in LEGACY_HEADINGS.items())
+    counter = Counter()
+    for tag in paragraphs:
+        for category in ("language", "culture", "music"):
+            if tag.get_text().lower() in headings[category]:
+                counter[category] += 1
+                break
+    return counter
+
+
+def index_classify(paragraphs):
+    headings = sushichef.get_activity_headings()
+    counter = Counter()
+    for tag in paragraphs:
+        category = headings.get(normalize_heading(tag.get_text()))
+        if category is not None:
+            counter[category] += 1
+    return counter
+
+
+def build_activities(lang, content):
+    # the activities Activities.to_file builds, without downloading them
+    node = sushichef.Activities(title=lang, source_id=lang, lang=lang)
+    node.body_cache = content
+    return ["{} {} files {} additional".format(activity.cls_name().lower(),
+        len(activity.elems) // 2, len(activity.additional)) for activity in node.activities()]
+
+
+def get_pages():
+    with open("resources.json", "r") as f:
+        resources = json.load(f)
+    return [(lang, subjects["activities"]["url"]) for lang, subjects in resources.items()
+        if "activities" in subjects]
+
+
+def record():
+    build_path([RECORDED_DIR])
+    for lang, url in get_pages():
+        document = sushichef.download(url)
+        content = None
+        if document is not None:
+            content = BeautifulSoup(document, "html5lib").find("div", class_="entry_content")
+        if content is None:
+            print("{}: could not download {}".format(lang, url))
+            continue
+        # only the part that is classified, the fixtures stay small
+        with open(os.path.join(RECORDED_DIR, "{}.html".format(lang)), "w", encoding="utf8") as f:
+            f.write(str(content) + "\n")
+        print("{}: recorded {}".format(lang, url))
+
+
+def bench(repeat):
+    for lang, url in get_pages():
+        filepath = os.path.join(RECORDED_DIR, "{}.html".format(lang))
+        if not file_exists(filepath):
+            print("{}: not recorded, run with --record".format(lang))
+            continue
+        with open(filepath, "r", encoding="utf8") as f:
+            soup = BeautifulSoup(f.read(), "html5lib")
+        content = soup.find("div", class_="entry_content")
+        paragraphs = content.find_all("p") if content is not None else []
+        results = []
+        for classify in (legacy_classify, index_classify):
+            start = time.perf_counter()
+            for _ in range(repeat):
+                counter = classify(paragraphs)
+            results.append(((time.perf_counter() - start) / repeat * 1000, counter))
+        (legacy_ms, legacy), (index_ms, index) = results
+        print("{}: {} paragraphs, legacy {:.2f} ms {}, index {:.2f} ms {}".format(
+            lang, len(paragraphs), legacy_ms, dict(legacy), index_ms, dict(index)))
+        if content is not None:
+            print("    nodes: {}".format(", ".join(build_activities(lang, content))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Activity headings benchmark")
+    parser.add_argument("--record", action="store_true",
+        help="download the activity pages of every language again")
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+    if args.record:
+        record()
+    bench(args.repeat)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# Measures the import time of the chef with `python -X importtime`, prints the
+# total startup cost and the slowest modules.
+#
+#     ./bench_importtime.py
+#     ./bench_importtime.py --module utils --top 10
+
+import argparse
+import subprocess
+import sys
+
+
+def importtime(module):
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c",
+        "import {}".format(module)], stderr=subprocess.PIPE,
+        stdout=subprocess.DEVNULL, universal_newlines=True)
+    timings = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        try:
+            self_us, cumulative_us = int(fields[0]), int(fields[1])
+        except ValueError:
+            # header line
+            continue
+        timings.append((fields[2].strip(), self_us, cumulative_us))
+    return proc.returncode, timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chef import time benchmark")
+    parser.add_argument("--module", default="sushichef")
+    parser.add_argument("--top", type=int, default=20)
+    args = parser.parse_args()
+
+    returncode, timings = importtime(args.module)
+    if returncode != 0 or len(timings) == 0:
+        print("Import of {} failed".format(args.module))
+        return 1
+    total = [t for t in timings if t[0] == args.module]
+    total_us = total[-1][2] if total else sum(t[1] for t in timings)
+    print("Import time of {}: {:.1f} ms ({} modules)".format(
+        args.module, total_us / 1000, len(timings)))
+    for name, self_us, cumulative_us in sorted(timings, key=lambda t: t[2],
+            reverse=True)[:args.top]:
+        print("{:>10.1f} ms {:>10.1f} ms  {}".format(cumulative_us / 1000,
+            self_us / 1000, name))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# Checks --changes against the sitemap fixture in fixtures/sitemap, served
+# locally: a run that fails does not mark its pages as stored, once a run
+# finishes the unchanged pages are not fetched again, and a resource built
+# from unchanged pages is reused without building it again.
+#
+#     ./check_changes.py
+
+from collections import Counter
+import functools
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+import os
+import sys
+import tempfile
+import threading
+
+import sushichef
+
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "sitemap")
+# the port of the urls in the fixture sitemaps
+PORT = 8765
+BASE_URL = "http://127.0.0.1:{}/".format(PORT)
+PAGES = [
+    ("resources/overview/", "div", dict(id="column-main")),
+    ("handbook/", "div", dict(class_="entry_content")),
+]
+
+requests_by_path = Counter()
+
+
+class RecordedSiteHandler(SimpleHTTPRequestHandler):
+    def do_GET(self):
+        requests_by_path[self.path] += 1
+        super(RecordedSiteHandler, self).do_GET()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def scrape_pages(pages_dir, commit):
+    # a run of the chef limited to the pages, with a fresh page cache
+    sushichef.page_cache.clear()
+    sushichef.site_changes = sushichef.SiteChanges(pages_dir)
+    sushichef.site_changes.load(BASE_URL, BASE_URL + "sitemap_index.xml")
+    for path, name, attrs in PAGES:
+        node = sushichef.ContentNode(title=path, source_id=BASE_URL + path)
+        if node.get_container(name, **attrs) is None:
+            raise RuntimeError("No {} {} in {}".format(name, attrs, path))
+    if commit:
+        sushichef.site_changes.commit()
+    return sushichef.site_changes.hits
+
+
+def build_overview(pages_dir, media_dir):
+    # a run of the chef limited to the overview resource
+    sushichef.page_cache.clear()
+    sushichef.site_changes = sushichef.SiteChanges(pages_dir)
+    sushichef.site_changes.load(BASE_URL, BASE_URL + "sitemap_index.xml")
+    sushichef.MEDIA_DIR = media_dir
+    chef = sushichef.FolkDCChef()
+    chef.build_config = ()
+    node = chef.build_resource(sushichef.Introduction(title="Overview",
+        source_id=BASE_URL + "resources/overview/"))
+    sushichef.site_changes.commit()
+    return node, sushichef.site_changes.tree_hits
+
+
+def check(description, expected, hits, expected_hits):
+    fetched = dict((path, requests_by_path["/" + path]) for path, _, _ in PAGES)
+    ok = fetched == expected and hits == expected_hits
+    print("{}: {} fetched {}, {} unchanged".format("ok" if ok else "FAIL",
+        description, fetched, hits))
+    return ok
+
+
+def main():
+    handler = functools.partial(RecordedSiteHandler, directory=FIXTURES_DIR)
+    server = HTTPServer(("127.0.0.1", PORT), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        with tempfile.TemporaryDirectory() as pages_dir:
+            results = []
+            # fails before the tree is written, nothing is committed
+            hits = scrape_pages(pages_dir, commit=False)
+            results.append(check("failed run", {"resources/overview/": 1, "handbook/": 1}, hits, 0))
+            hits = scrape_pages(pages_dir, commit=True)
+            results.append(check("run after a failure", {"resources/overview/": 2, "handbook/": 2}, hits, 0))
+            hits = scrape_pages(pages_dir, commit=True)
+            results.append(check("unchanged run", {"resources/overview/": 2, "handbook/": 2}, hits, 2))
+
+        # the html-app-starter files are not needed to build the zip
+        sushichef.app_assets.contents = {"styles.css": "", "scripts.js": ""}
+        with tempfile.TemporaryDirectory() as pages_dir, tempfile.TemporaryDirectory() as media_dir:
+            first, hits = build_overview(pages_dir, media_dir)
+            results.append(check("resource", {"resources/overview/": 3, "handbook/": 2}, hits, 0))
+            node, hits = build_overview(pages_dir, media_dir)
+            results.append(check("unchanged resource", {"resources/overview/": 3, "handbook/": 2},
+                hits, 1) and node == first)
+    finally:
+        server.shutdown()
+    return 0 if all(results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,42 +2,50 @@
 
 from bs4 import BeautifulSoup
 import codecs
+from concurrent.futures import ProcessPoolExecutor
 from collections import defaultdict, OrderedDict
 import copy
-from git import Repo
 import glob
 from le_utils.constants import licenses, content_kinds, file_formats, roles
 import hashlib
 import json
 import logging
-import markdown2
+import multiprocessing
 import ntpath
 import os
 from pathlib import Path
 import re
 import requests
+import socket
+import subprocess
 from ricecooker.classes.licenses import get_license
 from ricecooker.chefs import JsonTreeChef
 from ricecooker.utils import downloader, html_writer
 from ricecooker.utils.caching import CacheForeverHeuristic, FileCache, CacheControlAdapter
-from ricecooker.utils.html import download_file
 from ricecooker.utils.jsontrees import write_tree_to_json_tree, SUBTITLES_FILE
-from ricecooker.utils.zip import create_predictable_zip
 from pressurecooker.youtube import YouTubeResource
 import tempfile
 import time
+import tracemalloc
 from urllib.error import URLError
 from urllib.parse import urljoin
 from urllib.parse import urlparse, parse_qs 
-from utils import dir_exists, get_name_from_url, clone_repo, build_path
+from xml.etree import ElementTree
+from utils import dir_exists, get_name_from_url, build_path
 from utils import file_exists, get_video_resolution_format, remove_links
 from utils import get_name_from_url_no_ext, get_node_from_channel, get_level_map
 from utils import remove_iframes, get_confirm_token, save_response_content
-from utils import link_to_text, remove_scripts
+from utils import link_to_text, remove_scripts, TreeIndex
+from utils import normalize_url, PageCache, DownloadRegistry
+from utils import JsonTreeWriter, get_peak_rss, PoliteSession, WorkQueue
+from utils import HashCache, get_tree_paths, guess_size, iter_tree_nodes
+from utils import normalize_heading
 import yt_dlp as youtube_dl
 
 
 DATA_DIR = "chefdata"
+# where the downloaded media goes, shard workers use the shared directory
+MEDIA_DIR = DATA_DIR
 DATA_DIR_SUBJECT = ""
 COPYRIGHT_HOLDER = " European Commission"
 LICENSE = get_license(licenses.CC_BY_NC, 
@@ -54,11 +62,39 @@ DOWNLOAD_FILES = True
 DOWNLOAD_AUDIO = True
 LOAD_VIDEO_LIST = True
 OVERWRITE = True
+GENERATE_THUMBNAILS = True
+THUMBNAIL_WORKERS = 4
+ASSETS_MAX_AGE = 7 * 24 * 60 * 60
+# limit on the estimated memory of the cached containers, an html5lib tree
+# takes 30-40 bytes for each byte of its html (measured with tracemalloc)
+PAGE_CACHE_MAX_SIZE = 64 * 1024 * 1024
+PARSED_SIZE_FACTOR = 40
+# in low memory mode, about the page being built
+LOW_MEMORY_PAGE_CACHE_SIZE = 8 * 1024 * 1024
+HASH_WORKERS = 4
+# requests per second, burst and bytes per second (None is no limit) by host,
+# the shard workers on every host share them through the shard directory
+HOST_LIMITS = {
+    "folkdc.eu": dict(rate=2, burst=4, bandwidth=None),
+}
+# bytes per second for all the hosts together, None is no limit
+BANDWIDTH_LIMIT = None
 
-sess = requests.Session()
+sess = PoliteSession(requests.Session(), host_limits=HOST_LIMITS,
+    bandwidth=BANDWIDTH_LIMIT)
 cache = FileCache('.webcache')
 basic_adapter = CacheControlAdapter(cache=cache)
 forever_adapter = CacheControlAdapter(heuristic=CacheForeverHeuristic(), cache=cache)
+# parsed page containers shared by every node in the run
+page_cache = PageCache(PAGE_CACHE_MAX_SIZE)
+# md5 of the files in the tree, reused by the upload stage
+hash_cache = HashCache(os.path.join(DATA_DIR, "hashes.json"))
+# normalised activity heading -> category by file, see get_activity_headings()
+activity_headings = {}
+# set by FolkDCChef.plan() in dry run mode, no media is downloaded
+plan = None
+# files and audio downloaded in the run, keyed by node class and normalised url
+downloads = DownloadRegistry()
 
 # Run constants
 ################################################################################
@@ -85,9 +121,14 @@ LANG_MAP = {
     "Spanish": "es",
     "Portuguese": "pt",
     "Romanian": "ro",
-    "Roma": "rm"
+    "Roma": "rm",
+    "German": "de"
 }
 
+# languages of the songs included in each channel, set with --song-langs,
+# channels not listed (or None) include every song
+SONG_LANGS = {}
+
 
 def cached(fn):
     def view(*args, **kwargs):
@@ -123,6 +164,11 @@ class TopicNode:
 
         if node is not None:
             self.tree_nodes[node["source_id"]] = node
+        if isinstance(obj, TopicNode):
+            obj.release()
+
+    def release(self):
+        self.tree_nodes.clear()
 
     def add_nodes(self, nodes):
         for node in nodes:
@@ -204,13 +250,9 @@ class Html5Node(Node):
         return images_urls
 
     def write_css_js(self, filepath):
-        with html_writer.HTMLWriter(filepath, "a") as zipper, open("chefdata/styles.css") as f:
-            content = f.read()
-            zipper.write_contents("styles.css", content, directory="css/")
-
-        with html_writer.HTMLWriter(filepath, "a") as zipper, open("chefdata/scripts.js") as f:
-            content = f.read()
-            zipper.write_contents("scripts.js", content, directory="js/")
+        with html_writer.HTMLWriter(filepath, "a") as zipper:
+            zipper.write_contents("styles.css", app_assets.get("styles.css"), directory="css/")
+            zipper.write_contents("scripts.js", app_assets.get("scripts.js"), directory="js/")
 
     def write_index(self, filepath, content):
         with html_writer.HTMLWriter(filepath, "w") as zipper:
@@ -236,8 +278,18 @@ class Html5Node(Node):
             LOGGER.info("Not overwrited file {}".format(self.filepath))
         else:
             self.filepath = filepath
-            body = self.clean(self.body)
+            # the body can be shared through the page cache, clean a copy
+            self.body = self.clean(copy.copy(self.body))
+            body = self.body
             images = self.to_local_images(body)
+            if plan is not None:
+                for img_src in images:
+                    if not img_src.startswith("data:image/") and not img_src.startswith("file://")\
+                            and plan.first("image", img_src):
+                        # the run only sends the GET, the probe is for the size
+                        plan.add("image", probe(img_src)[1], requests=1)
+                self.filepath = None
+                return
             try:
                 self.write_index(self.filepath, '<html><head><meta charset="utf-8"><link rel="stylesheet" href="css/styles.css"></head><body><div class="main-content-with-sidebar">{}</div><script src="js/scripts.js"></script></body></html>'.format(body))
             except RuntimeError as e:
@@ -271,6 +323,40 @@ class ContentNode(Node):
         if document is not None:
             return BeautifulSoup(document, 'html5lib') #html5lib
 
+    def release(self):
+        super(ContentNode, self).release()
+        if hasattr(self, "body_cache"):
+            del self.body_cache
+
+    def get_container(self, name, **attrs):
+        key = (normalize_url(self.source_id), name, tuple(sorted(attrs.items())))
+        site_changes.visit(key[0])
+        container = page_cache.get(key)
+        if container is not None:
+            return container
+        html = site_changes.get_page(key)
+        if html is not None:
+            container = BeautifulSoup(html, 'html5lib').find(name, **attrs)
+            if container is not None:
+                container.extract()
+                page_cache.set(key, container, len(html) * PARSED_SIZE_FACTOR)
+                return container
+        LOGGER.info("DOWNLOADING: {}".format(self.source_id))
+        document = download(self.source_id)
+        if document is None:
+            return None
+        if plan is not None:
+            plan.add("html", len(document.encode("utf-8")))
+        soup = BeautifulSoup(document, 'html5lib')
+        container = soup.find(name, **attrs)
+        if container is not None:
+            # detach it so the rest of the page can be released
+            container.extract()
+            html = str(container)
+            page_cache.set(key, container, len(html) * PARSED_SIZE_FACTOR)
+            site_changes.set_page(key, html)
+        return container
+
     def get_videos_urls(self, content):
         urls = set([])
         if content is not None:
@@ -321,10 +407,14 @@ class ContentNode(Node):
 
     def build_video_nodes(self, base_path, content):
         videos_url = self.get_videos_urls(content)
-        base_path = build_path([DATA_DIR])
+        base_path = build_path([MEDIA_DIR])
         video_nodes = []
         for video_url in videos_url:
             if YouTubeResource.is_youtube(video_url) and not YouTubeResource.is_channel(video_url):
+                if plan is not None:
+                    size, requests_count = probe_video(video_url)
+                    plan.add("video", size, requests=requests_count)
+                    continue
                 video = YouTubeResourceNode(video_url, lang=self.lang)
                 video.download(download=DOWNLOAD_VIDEOS, base_path=base_path)
                 yield video
@@ -346,26 +436,39 @@ class ContentNode(Node):
 class Introduction(ContentNode):
     @cached
     def body(self):
-        soup = self.to_soup()
-        return soup.find("div", id="column-main")
+        return self.get_container("div", id="column-main")
 
 
 class Song(ContentNode):
     @cached
     def body(self):
-        soup = self.to_soup()
-        return soup.find("div", id="column-main")
+        return self.get_container("div", id="column-main")
 
     def to_file(self, base_path):
         if self.body() is not None:
+            langs = SONG_LANGS.get(self.lang)
+            skipped = 0
+            skipped_files = OrderedDict()
             rows = self.body().find("table").find("tbody").find_all("tr")
             for row in rows:
                 cells = row.find_all("td")
                 if len(cells) == 5:
                     title = cells[0].get_text()
-                    lang = LANG_MAP.get(cells[1].get_text(), "en")
+                    name = cells[1].get_text().strip()
+                    lang = LANG_MAP.get(name)
+                    if lang is None and langs is None:
+                        lang = "en"
+                    elif lang is None:
+                        # matched by its name and left without a language
+                        LOGGER.warning("Unknown language {} of the song {}".format(name, title))
                     pdf_url = cells[2].find("a").attrs.get("href", "")
                     audio_url = cells[3].find("a").attrs.get("href", "")
+                    if langs is not None and (lang or name.lower()) not in langs:
+                        skipped += 1
+                        for node in (Audio(source_id=audio_url, lang=lang, title=title),
+                                File(source_id=pdf_url, lang=lang, title=title)):
+                            skipped_files[node.download_key()] = node.source_id
+                        continue
                     audio_node = Audio(source_id=audio_url, lang=lang, title=title)
                     audio_node.download(download=DOWNLOAD_AUDIO, base_path=base_path)
                     pdf_node = File(source_id=pdf_url, lang=lang, title=title)
@@ -374,50 +477,52 @@ class Song(ContentNode):
                     topic_node.add_node(audio_node)
                     topic_node.add_node(pdf_node)
                     self.add_node(topic_node)
+            if langs is not None:
+                # the files of a kept song (downloaded once) are not saved
+                saved = [url for key, url in skipped_files.items() if key not in downloads]
+                LOGGER.info("Songs not in {}: skipped {}, saved {} requests and ~{:.1f} MB".format(
+                    ", ".join(langs), skipped, len(saved) * (PROBE_REQUESTS + 1),
+                    sum(self.estimate_size(url, base_path) for url in saved) / 2**20))
         else:
             LOGGER.error("Empty body in {}".format(self.source_id))
             return
 
+    def estimate_size(self, url, base_path):
+        # the size of the copy of an earlier run, or a guess from the extension
+        filepath = os.path.join(base_path, get_name_from_url(url))
+        if file_exists(filepath):
+            return os.path.getsize(filepath)
+        return guess_size(url)
+
 
 class Activities(ContentNode):
     @cached
     def body(self):
-        soup = self.to_soup()
-        return soup.find("div", class_="entry_content")
+        return self.get_container("div", class_="entry_content")
 
-    def to_file(self, base_path):
-        language_activities = ["LANGUAGE ACTIVITIES", "Sprachliche Aktivitäten", 
-            "ATTIVITÀ LINGUISTICHE", "KIELITEHTÄVÄT", "ACTIVITĂŢI LINGVISTICE",
-            "DİL AKTİVİTELERİ"]
-        cultural_activities = ["ACTIVIDADES CULTURALES", "Kulturelle Aktivitäten", 
-            "CULTURAL ACTIVITIES", "ATTIVITÀ CULTURALI", "KULTTUURITEHTÄVÄT",
-            "ACTIVITĂŢI CULTURALE", "KÜLTÜREL AKTİVİTELERE"]
-        musical_activities = ["ACTIVIDADES MUSICALES", "Musikalische Aktivitäten", 
-            "MUSICAL ACTIVITIES", "ATTIVITÀ MUSICALI", "MUSIIKKITEHTÄVÄT",
-            "ACTIVITĂŢI MUZICALE", "MÜZİK AKTİVİTELERİ"]
-
-        language_activities = [string.lower() for string in language_activities]
-        cultural_activities = [string.lower() for string in cultural_activities]
-        musical_activities = [string.lower() for string in musical_activities]
-        
+    def activities(self):
+        # the activity of each heading, with the links of the paragraph after it
+        headings = get_activity_headings()
         activity = None
         for tag in self.body().find_all("p"):
-            if tag.get_text().lower() in language_activities:
-                activity = Language(title=tag.get_text(), source_id=tag.get_text(), lang=self.lang)
-            elif tag.get_text().lower() in cultural_activities:
-                activity = Culture(title=tag.get_text(), source_id=tag.get_text(), lang=self.lang)
-            elif tag.get_text().lower() in musical_activities:
-                 activity = Music(title=tag.get_text(), source_id=tag.get_text(), lang=self.lang)
+            text = tag.get_text()
+            category = headings.get(normalize_heading(text))
+            if category is not None:
+                activity = ACTIVITY_CLASSES[category](title=text, source_id=text, lang=self.lang)
 
             if tag.children is not None and activity is not None:
                 children = list(tag.children)
                 if len(children) > 1:
                     for elem in children:
                         activity.add_tag(elem)
-                    activity.to_file(base_path)
-                    self.add_node(activity)
+                    yield activity
                     activity = None
 
+    def to_file(self, base_path):
+        for activity in self.activities():
+            activity.to_file(base_path)
+            self.add_node(activity)
+
 
 class Language(ContentNode):
     def __init__(self, *args, **kwargs):
@@ -457,11 +562,31 @@ class Music(Language):
     pass
 
 
+ACTIVITY_CLASSES = {
+    "language": Language,
+    "culture": Culture,
+    "music": Music
+}
+
+
+def get_activity_headings(filename="resources.json"):
+    # the headings of every language classify the paragraphs of any page
+    if filename not in activity_headings:
+        index = {}
+        with open(filename, "r") as f:
+            for lang, subjects in json.load(f).items():
+                headings = subjects.get("activities", {}).get("headings", {})
+                for category, texts in headings.items():
+                    for text in texts:
+                        index[normalize_heading(text)] = category
+        activity_headings[filename] = index
+    return activity_headings[filename]
+
+
 class AdditionalMaterial(ContentNode):
     @cached
     def body(self):
-        soup = self.to_soup()
-        return soup.find("div", class_="entry_content")
+        return self.get_container("div", class_="entry_content")
 
     def to_file(self, base_path):
         if self.body() is not None:
@@ -488,7 +613,7 @@ def save_thumbnail(url, title):
     import imghdr
     from io import BytesIO
     try:
-        r = requests.get(url)
+        r = sess.get(url, headers=AGENT_HEADERS, timeout=10)
     except Exception as e:
         logging.error("Error: %s", e)
         return None
@@ -504,6 +629,101 @@ def save_thumbnail(url, title):
             return filepath
 
 
+def is_environment_error(e):
+    # a missing converter, out of memory or a killed process, not the file
+    from pdf2image.exceptions import PopplerNotInstalledError, PDFPopplerTimeoutError
+    if isinstance(e, subprocess.CalledProcessError):
+        return e.returncode < 0
+    return isinstance(e, (ImportError, OSError, MemoryError, PopplerNotInstalledError,
+        PDFPopplerTimeoutError))
+
+
+def make_thumbnail(kind, filepath, thumbnail_path):
+    # runs in the thumbnails process pool, only the errors of the file are
+    # returned, the others stop the run
+    from pressurecooker.images import ThumbnailGenerationError
+    try:
+        if kind == content_kinds.DOCUMENT:
+            from pressurecooker.images import create_image_from_pdf_page
+            create_image_from_pdf_page(filepath, thumbnail_path)
+        elif kind == content_kinds.VIDEO:
+            from pressurecooker.videos import extract_thumbnail_from_video
+            extract_thumbnail_from_video(filepath, thumbnail_path, overwrite=True)
+        elif kind == content_kinds.HTML5:
+            from pressurecooker.images import create_image_from_zip
+            create_image_from_zip(filepath, thumbnail_path)
+    except ThumbnailGenerationError as e:
+        # pressurecooker wraps every error, the original one is the context
+        if is_environment_error(e.__context__):
+            raise
+        return None, "{}: {}".format(filepath, e)
+    if file_exists(thumbnail_path):
+        return thumbnail_path, None
+    return None, "{}: no thumbnail".format(filepath)
+
+
+def generate_thumbnails(tree, base_path, workers=THUMBNAIL_WORKERS):
+    # thumbnails are named by the md5 of the content, so they are only made
+    # once for each file and shared by the nodes with the same content
+    kinds = (content_kinds.DOCUMENT, content_kinds.VIDEO, content_kinds.HTML5)
+    nodes = defaultdict(list)
+    jobs = OrderedDict()
+    # md5 -> error of the files no thumbnail can be made from
+    failed_path = os.path.join(base_path, "failed.json")
+    failed = {}
+    if file_exists(failed_path):
+        with open(failed_path, "r") as f:
+            failed = json.load(f)
+        if not isinstance(failed, dict):
+            # the list of earlier versions has the environment errors too
+            failed = {}
+
+    candidates = []
+    for node in iter_tree_nodes(tree):
+        if node.get("thumbnail") or node.get("kind") not in kinds:
+            continue
+        paths = [file_["path"] for file_ in node.get("files") or [] if file_.get("path")]
+        if len(paths) > 0 and file_exists(paths[0]):
+            candidates.append((node, paths[0]))
+    # the videos are not hashed when downloaded, hash them in parallel
+    hash_cache.hash_files([path for _, path in candidates], workers=HASH_WORKERS)
+
+    for node, path in candidates:
+        md5 = hash_cache.get(path)
+        if md5 in failed:
+            continue
+        thumbnail_path = os.path.join(base_path, "{}.png".format(md5))
+        nodes[thumbnail_path].append(node)
+        if not file_exists(thumbnail_path):
+            jobs[thumbnail_path] = (node["kind"], path, md5)
+
+    generated = 0
+    if len(jobs) > 0:
+        try:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [(md5, executor.submit(make_thumbnail, kind, filepath, thumbnail_path))
+                    for thumbnail_path, (kind, filepath, md5) in jobs.items()]
+                for md5, future in futures:
+                    # raises the environment errors, and BrokenProcessPool
+                    # when a worker is killed
+                    thumbnail_path, error = future.result()
+                    if error is not None:
+                        LOGGER.info("Thumbnail error {}".format(error))
+                        failed[md5] = error
+                    else:
+                        generated += 1
+        finally:
+            with open(failed_path, "w") as f:
+                json.dump(failed, f, indent=2, sort_keys=True)
+
+    for thumbnail_path, thumbnail_nodes in nodes.items():
+        if file_exists(thumbnail_path):
+            for node in thumbnail_nodes:
+                node["thumbnail"] = thumbnail_path
+    LOGGER.info("Thumbnails: {} generated, {} from cache, {} failed".format(
+        generated, len(nodes) - len(jobs), len(jobs) - generated))
+
+
 class YouTubeResourceNode(YouTubeResource):
     def __init__(self, source_id, name=None, type_name="Youtube", lang="en",
             embeded=False, section_title=None):
@@ -640,18 +860,42 @@ class File(Node):
         self.filepath = None
         self.name = get_name_from_url_no_ext(self.filename)
 
+    def download_key(self):
+        return (self.cls_name(), normalize_url(self.source_id))
+
     def download(self, download=True, base_path=None):
+        if download is False:
+            return
+        self.filepath = downloads.get_or_download(self.download_key(),
+            lambda: self.fetch(base_path))
+        return self.filepath
+
+    def fetch(self, base_path):
+        if plan is not None and not plan.first(self.cls_name(), self.source_id):
+            return
+        content_type, size, probes = probe(self.source_id)
+        if content_type is not None and 'application/pdf' not in content_type:
+            LOGGER.info("    - Skip {}, content type {}".format(self.source_id, content_type))
+            if plan is not None:
+                plan.add("pdf", 0, requests=probes)
+            return
+        if plan is not None:
+            plan.add("pdf", size, requests=probes + 1)
+            return
         try:
-            if download is False:
-                return
-            response = sess.get(self.source_id, headers=AGENT_HEADERS, timeout=10)
+            response = sess.get(self.source_id, headers=AGENT_HEADERS, timeout=10,
+                stream=True, size=size)
             content_type = response.headers.get('content-type')
             if content_type is not None and 'application/pdf' in content_type:
-                self.filepath = os.path.join(base_path, self.filename)
-                with open(self.filepath, 'wb') as f:
+                filepath = os.path.join(base_path, self.filename)
+                md5 = hashlib.md5()
+                with open(filepath, 'wb') as f:
                     for chunk in response.iter_content(10000):
                         f.write(chunk)
+                        md5.update(chunk)
+                hash_cache.set(filepath, md5.hexdigest())
                 LOGGER.info("    - Get file: {}, node name: {}".format(self.filename, self.name))
+                return filepath
         except requests.exceptions.HTTPError as e:
             LOGGER.info("Error: {}".format(e))
         except requests.exceptions.ConnectionError:
@@ -691,18 +935,42 @@ class Audio(Node):
         self.filepath = None
         self.name = get_name_from_url_no_ext(self.filename)
 
+    def download_key(self):
+        return (self.cls_name(), normalize_url(self.source_id))
+
     def download(self, download=True, base_path=None):
+        if download is False:
+            return
+        self.filepath = downloads.get_or_download(self.download_key(),
+            lambda: self.fetch(base_path))
+        return self.filepath
+
+    def fetch(self, base_path):
+        if plan is not None and not plan.first(self.cls_name(), self.source_id):
+            return
+        content_type, size, probes = probe(self.source_id)
+        if content_type is not None and 'audio/mpeg' not in content_type:
+            LOGGER.info("    - Skip {}, content type {}".format(self.source_id, content_type))
+            if plan is not None:
+                plan.add("audio", 0, requests=probes)
+            return
+        if plan is not None:
+            plan.add("audio", size, requests=probes + 1)
+            return
         try:
-            if download is False:
-                return
-            response = sess.get(self.source_id, headers=AGENT_HEADERS, timeout=10)
+            response = sess.get(self.source_id, headers=AGENT_HEADERS, timeout=10,
+                stream=True, size=size)
             content_type = response.headers.get('content-type')
             if content_type is not None and 'audio/mpeg' in content_type:
-                self.filepath = os.path.join(base_path, self.filename)
-                with open(self.filepath, 'wb') as f:
+                filepath = os.path.join(base_path, self.filename)
+                md5 = hashlib.md5()
+                with open(filepath, 'wb') as f:
                     for chunk in response.iter_content(10000):
                         f.write(chunk)
+                        md5.update(chunk)
+                hash_cache.set(filepath, md5.hexdigest())
                 LOGGER.info("    - Get audio file: {}, node name: {}".format(self.filename, self.name))
+                return filepath
         except requests.exceptions.HTTPError as e:
             LOGGER.info("Error: {}".format(e))
         except requests.exceptions.ConnectionError:
@@ -733,6 +1001,107 @@ class Audio(Node):
             return node
 
 
+# requests sent by probe() to a server that answers HEAD
+PROBE_REQUESTS = 1
+
+
+def probe(url, timeout=10):
+    # content type, size and number of requests sent, without downloading the
+    # body, servers that do not answer HEAD properly are asked for the first
+    # byte only
+    requests_count = 1
+    try:
+        response = sess.head(url, headers=AGENT_HEADERS, timeout=timeout,
+            allow_redirects=True)
+        if response.status_code >= 400 or 'content-length' not in response.headers:
+            headers = dict(AGENT_HEADERS, Range="bytes=0-0")
+            requests_count += 1
+            response = sess.get(url, headers=headers, timeout=timeout, stream=True)
+            response.close()
+    except requests.exceptions.RequestException as e:
+        LOGGER.info("Error: {}".format(e))
+        return None, None, requests_count
+
+    if response.status_code >= 400:
+        return None, None, requests_count
+    content_type = response.headers.get('content-type')
+    size = None
+    content_range = response.headers.get('content-range', '')
+    if response.status_code == 206 and content_range.find("/") != -1:
+        total = content_range.split("/")[-1]
+        if total.isdigit():
+            size = int(total)
+    elif response.headers.get('content-length', '').isdigit():
+        size = int(response.headers['content-length'])
+    return content_type, size, requests_count
+
+
+def probe_video(url):
+    # size of the formats that would be downloaded and the number of requests,
+    # the info extraction and one download for each format
+    ydl_options = {
+        'no_warnings': True,
+        'quiet': True,
+        'format': "bestvideo[height<={maxheight}][ext=mp4]+bestaudio[ext=m4a]/best[height<={maxheight}][ext=mp4]".format(maxheight='480'),
+        'noplaylist': True
+    }
+    with youtube_dl.YoutubeDL(ydl_options) as ydl:
+        try:
+            info = ydl.extract_info(url, download=False)
+        except (youtube_dl.utils.DownloadError, youtube_dl.utils.ExtractorError) as e:
+            LOGGER.info("Error: {}".format(e))
+            return None, 1
+    formats = info.get("requested_formats") or [info]
+    sizes = [f.get("filesize") or f.get("filesize_approx") for f in formats]
+    if any(size is None for size in sizes):
+        return None, 1 + len(formats)
+    return sum(sizes), 1 + len(formats)
+
+
+# Requests and bytes expected for each language, resource and kind of file
+class Plan(object):
+    def __init__(self):
+        self.section = None
+        self.stats = OrderedDict()
+        self.seen = set()
+
+    def first(self, kind, url):
+        # the run downloads each url once, failed or not the plan counts it once
+        key = (kind, normalize_url(url))
+        if key in self.seen:
+            return False
+        self.seen.add(key)
+        return True
+
+    def start_lang(self):
+        # every language is planned as if it was run on its own
+        self.seen.clear()
+        page_cache.clear()
+        downloads.clear()
+
+    def add(self, kind, size, requests=1):
+        key = self.section + (kind,)
+        stats = self.stats.setdefault(key, dict(requests=0, bytes=0, unknown=0))
+        stats["requests"] += requests
+        if size is None:
+            stats["unknown"] += 1
+        else:
+            stats["bytes"] += size
+
+    def report(self):
+        totals = OrderedDict()
+        for (lang, section, kind), stats in self.stats.items():
+            LOGGER.info("{:<4} {:<14} {:<6} {:>6} requests {:>10.1f} MB{}".format(
+                lang, section, kind, stats["requests"], stats["bytes"] / 2**20,
+                " ({} unknown size)".format(stats["unknown"]) if stats["unknown"] else ""))
+            total = totals.setdefault(lang, dict(requests=0, bytes=0))
+            total["requests"] += stats["requests"]
+            total["bytes"] += stats["bytes"]
+        for lang, total in totals.items():
+            LOGGER.info("{:<4} total: {} requests, {:.1f} MB".format(
+                lang, total["requests"], total["bytes"] / 2**20))
+
+
 def download(source_id, loadjs=False, timeout=5):
     tries = 0
     while tries < 4:
@@ -758,62 +1127,523 @@ def download(source_id, loadjs=False, timeout=5):
         tries += 1
 
 
+def install_hash_cache():
+    # ricecooker reads and hashes every local file on each upload, reuse the
+    # md5 from hash_cache and skip the copy when storage already has it
+    from ricecooker import config
+    from ricecooker.classes import files
+    if not hasattr(files, "download"):
+        # ricecooker>=0.7 moved the file handling out of files.download
+        LOGGER.warning("This ricecooker version has no files.download, "
+            "the upload will hash the files again")
+        return
+    if getattr(files.download, "hash_cache", False):
+        return
+    download = files.download
+
+    def cached_download(path, default_ext=None):
+        md5 = None
+        if not config.UPDATE and file_exists(path):
+            md5 = hash_cache.get(path)
+        if md5 is None:
+            return download(path, default_ext=default_ext)
+        filename = "{}.{}".format(md5, files.extract_path_ext(path, default_ext=default_ext))
+        storage_path = config.get_storage_path(filename)
+        if not file_exists(storage_path) or os.path.getsize(storage_path) != os.path.getsize(path):
+            files.copy_file_to_storage(filename, path)
+        return filename
+    cached_download.hash_cache = True
+    files.download = cached_download
+
+
+# Keeps the extracted containers of the pages listed in the WordPress sitemap
+# with their lastmod, a page whose lastmod has not changed since it was stored
+# is not fetched again
+class SiteChanges(object):
+    SITEMAPS = ["sitemap_index.xml", "wp-sitemap.xml", "sitemap.xml"]
+
+    def __init__(self, base_path):
+        self.base_path = base_path
+        self.lastmods = {}
+        self.enabled = False
+        self.hits = 0
+        self.tree_hits = 0
+        # pages fetched in this run, stored as <name>.json.new until commit()
+        self.pending = set()
+        # url -> lastmod of the pages read while a resource is built
+        self.visited = None
+
+    def load(self, base_url, sitemap_url=None):
+        build_path([self.base_path])
+        if sitemap_url is not None:
+            urls = [sitemap_url]
+        else:
+            urls = [urljoin(base_url, name) for name in SiteChanges.SITEMAPS]
+        for url in urls:
+            self.lastmods = self.read_sitemap(url)
+            if len(self.lastmods) > 0:
+                LOGGER.info("Sitemap {}: {} pages".format(url, len(self.lastmods)))
+                break
+        else:
+            LOGGER.warning("No sitemap found, every page will be fetched")
+        self.enabled = len(self.lastmods) > 0
+
+    def read_sitemap(self, url, depth=0):
+        try:
+            response = sess.get(url, headers=AGENT_HEADERS, timeout=10)
+            response.raise_for_status()
+            root = ElementTree.fromstring(response.content)
+        except (requests.exceptions.RequestException, ElementTree.ParseError) as e:
+            LOGGER.info("Error: {}".format(e))
+            return {}
+
+        lastmods = {}
+        for elem in root:
+            values = dict((child.tag.split("}")[-1], (child.text or "").strip()) for child in elem)
+            loc = values.get("loc")
+            if not loc:
+                continue
+            tag = elem.tag.split("}")[-1]
+            # the index lists the sitemaps of each post type and taxonomy
+            if tag == "sitemap" and depth < 2:
+                lastmods.update(self.read_sitemap(loc, depth=depth + 1))
+            elif tag == "url" and values.get("lastmod"):
+                lastmods[normalize_url(loc)] = values["lastmod"]
+        return lastmods
+
+    def get_filepath(self, key):
+        name = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+        return os.path.join(self.base_path, "{}.json".format(name))
+
+    def read(self, key):
+        filepath = self.get_filepath(key)
+        if filepath + ".new" in self.pending:
+            filepath += ".new"
+        if not self.enabled or not file_exists(filepath):
+            return None
+        with open(filepath, "r", encoding="utf8") as f:
+            return json.load(f)
+
+    def write(self, key, value):
+        filepath = self.get_filepath(key) + ".new"
+        with open(filepath, "w", encoding="utf8") as f:
+            json.dump(value, f, ensure_ascii=False)
+        self.pending.add(filepath)
+
+    def visit(self, url):
+        if self.visited is not None:
+            self.visited[url] = self.lastmods.get(url)
+
+    def get_page(self, key):
+        lastmod = self.lastmods.get(key[0])
+        page = self.read(key)
+        if lastmod is None or page is None:
+            return None
+        if page.get("lastmod") != lastmod:
+            return None
+        self.hits += 1
+        return page["html"]
+
+    def set_page(self, key, html):
+        lastmod = self.lastmods.get(key[0])
+        if not self.enabled or lastmod is None:
+            return
+        self.write(key, dict(url=key[0], lastmod=lastmod, html=html))
+
+    def get_tree(self, key):
+        # the subtree built from the same pages, if none of them changed and
+        # its media are still on disk
+        stored = self.read(("tree",) + key)
+        if stored is None:
+            return None
+        for url, lastmod in stored["pages"].items():
+            if self.lastmods.get(url) != lastmod:
+                return None
+        if not all(file_exists(path) for path in get_tree_paths(stored["tree"])):
+            return None
+        self.tree_hits += 1
+        return stored["tree"]
+
+    def set_tree(self, key, tree, pages):
+        # only when every page it was built from has a lastmod
+        if not self.enabled or tree is None or len(pages) == 0 or None in pages.values():
+            return
+        self.write(("tree",) + key, dict(pages=pages, tree=tree))
+
+    def commit(self):
+        # called once the tree is written, a run that fails before leaves the
+        # stored pages as they were and they are fetched again next time
+        for filepath in self.pending:
+            os.replace(filepath, filepath[:-len(".new")])
+        self.pending.clear()
+
+
+site_changes = SiteChanges(os.path.join(DATA_DIR, "pages"))
+
+
+# Local copy of the html-app-starter css/js, stored by content hash and
+# revalidated with conditional requests once it is older than max_age
+class AppAssets(object):
+    ASSETS = OrderedDict([
+        ("styles.css", "https://raw.githubusercontent.com/learningequality/html-app-starter/master/css/styles.css"),
+        ("scripts.js", "https://raw.githubusercontent.com/learningequality/html-app-starter/master/js/scripts.js"),
+    ])
+
+    def __init__(self, base_path):
+        self.base_path = base_path
+        self.manifest_path = os.path.join(base_path, "manifest.json")
+        self.manifest = {}
+        self.contents = {}
+
+    def load(self, max_age=ASSETS_MAX_AGE):
+        build_path([self.base_path])
+        if file_exists(self.manifest_path):
+            with open(self.manifest_path, "r") as f:
+                self.manifest = json.load(f)
+        for name, url in AppAssets.ASSETS.items():
+            info = self.manifest.get(name)
+            content = self.read(info)
+            if content is None or info.get("url") != url or\
+                    time.time() - info.get("checked", 0) > max_age:
+                content = self.refresh(name, url, info if content is not None else None) or content
+            if content is None:
+                raise RuntimeError("No local copy of {} and it could not be downloaded".format(name))
+            self.contents[name] = content.decode("utf-8")
+        # the shard workers load the assets at the same time
+        tmppath = "{}.{}.tmp".format(self.manifest_path, os.getpid())
+        with open(tmppath, "w") as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmppath, self.manifest_path)
+
+    def read(self, info):
+        if info is None:
+            return None
+        filepath = os.path.join(self.base_path, info["filename"])
+        if not file_exists(filepath):
+            return None
+        with open(filepath, "rb") as f:
+            content = f.read()
+        if hashlib.sha1(content).hexdigest() != info["sha1"]:
+            return None
+        return content
+
+    def refresh(self, name, url, info=None):
+        headers = dict(AGENT_HEADERS)
+        if info is not None and info.get("url") == url:
+            if info.get("etag"):
+                headers["If-None-Match"] = info["etag"]
+            if info.get("last_modified"):
+                headers["If-Modified-Since"] = info["last_modified"]
+        try:
+            response = sess.get(url, headers=headers, timeout=10)
+            if response.status_code == 304:
+                info["checked"] = time.time()
+                return None
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            LOGGER.warning("Could not refresh {}, using the last good copy: {}".format(name, e))
+            return None
+
+        content = response.content
+        sha1 = hashlib.sha1(content).hexdigest()
+        root, ext = os.path.splitext(name)
+        filename = "{}.{}{}".format(root, sha1[:12], ext)
+        filepath = os.path.join(self.base_path, filename)
+        if not file_exists(filepath):
+            with open(filepath, "wb") as f:
+                f.write(content)
+        self.manifest[name] = dict(url=url, filename=filename, sha1=sha1,
+            etag=response.headers.get("etag"),
+            last_modified=response.headers.get("last-modified"),
+            checked=time.time())
+        LOGGER.info("Updated {} ({})".format(name, sha1[:12]))
+        return content
+
+    def get(self, name):
+        return self.contents[name]
+
+
+app_assets = AppAssets(os.path.join(DATA_DIR, "assets"))
+
+
 # The chef subclass
 ################################################################################
+def set_song_langs(song_langs, langs):
+    # "own" stands for the language of each channel
+    for lang in langs:
+        SONG_LANGS[lang] = None if song_langs == "all" else list(OrderedDict.fromkeys(
+            lang if name == "own" else name for name in song_langs.split(",")))
+
+
+def rebase_tree_paths(tree, rebase):
+    for node in iter_tree_nodes(tree):
+        if node.get("thumbnail"):
+            node["thumbnail"] = rebase(node["thumbnail"])
+        for file_ in node.get("files") or []:
+            if file_.get("path"):
+                file_["path"] = rebase(file_["path"])
+
+
+def shard_worker(shards_dir, song_langs=None, langs=(), assets_max_age=ASSETS_MAX_AGE):
+    # everything is loaded here, the process may be spawned instead of forked
+    global MEDIA_DIR, hash_cache
+    MEDIA_DIR = os.path.join(shards_dir, "media")
+    # the files are hashed as they are downloaded, the merge reads these,
+    # relative like the tree paths
+    hash_cache = HashCache(os.path.join(shards_dir, "hashes.json"), root=shards_dir)
+    # the host limits are for all the workers together, not each of them
+    sess.share(os.path.join(shards_dir, "queue.sqlite"))
+    app_assets.load(max_age=assets_max_age)
+    if song_langs is not None:
+        set_song_langs(song_langs, langs)
+    queue = WorkQueue(os.path.join(shards_dir, "queue.sqlite"))
+    worker = "{}-{}".format(socket.gethostname(), os.getpid())
+    while True:
+        unit = queue.claim(worker)
+        if unit is None:
+            break
+        unit_id, lang, section, position = unit
+        LOGGER.info("{}: {} {} ({})".format(worker, lang, section, position))
+        try:
+            resources = Resource(lang=lang)
+            resources.load("resources.json")
+            resource = resources.resources[position]
+            base_path = build_path([MEDIA_DIR, resource.lang, resource.cls_name()])
+            resource.to_file(base_path)
+            node = resource.to_dict()
+            resource.release()
+            page_cache.clear()
+            # media paths relative to the shared directory, the merge host
+            # may mount it somewhere else
+            rebase_tree_paths(node, lambda path: os.path.relpath(path, shards_dir))
+            filepath = os.path.join(build_path([shards_dir, lang]),
+                "{:03d}_{}.json".format(position, section))
+            with open(filepath + ".tmp", "w", encoding="utf8") as f:
+                json.dump(node, f, indent=2, ensure_ascii=False)
+            os.replace(filepath + ".tmp", filepath)
+        except Exception as e:
+            LOGGER.exception(e)
+            queue.fail(unit_id, str(e))
+        else:
+            hash_cache.save()
+            # relative, the shared directory can be mounted elsewhere by the merge
+            queue.complete(unit_id, os.path.relpath(filepath, shards_dir))
+
+
 class FolkDCChef(JsonTreeChef):
     TREES_DATA_DIR = os.path.join(DATA_DIR, 'trees')
+    SHARDS_DATA_DIR = os.path.join(DATA_DIR, 'shards')
     SCRAPING_STAGE_OUTPUT_TPL = 'ricecooker_{lang}_json_tree.json'
     BASE_URL = "https://folkdc.eu/"
 
+    def run(self, args, options):
+        shard = options.get('--shard')
+        if '--song-langs' in options:
+            set_song_langs(options['--song-langs'], self.get_langs(options))
+        if bool(int(options.get('--plan', "0"))):
+            self.plan(args, options)
+        elif shard == "coordinator":
+            self.shard_coordinator(args, options)
+        elif shard == "worker":
+            self.shard_workers(args, options)
+        else:
+            super(FolkDCChef, self).run(args, options)
+
+    def get_langs(self, options):
+        if '--lang' in options:
+            return [options['--lang']]
+        with open("resources.json", "r") as f:
+            return list(json.load(f).keys())
+
+    def shard_coordinator(self, args, options):
+        shards_dir = build_path([options.get('--shard-dir', FolkDCChef.SHARDS_DATA_DIR)])
+        queue = WorkQueue(os.path.join(shards_dir, "queue.sqlite"))
+        for lang in self.get_langs(options):
+            resources = Resource(lang=lang)
+            resources.load("resources.json")
+            for position, resource in enumerate(resources):
+                queue.put(lang, resource.cls_name(), position)
+        LOGGER.info("Queued {} units in {}".format(len(queue.units()), shards_dir))
+
+    def shard_workers(self, args, options):
+        shards_dir = options.get('--shard-dir', FolkDCChef.SHARDS_DATA_DIR)
+        refresh_assets = bool(int(options.get('--refresh-assets', "0")))
+        # refreshed once here, the workers then load the fresh local copy
+        app_assets.load(max_age=0 if refresh_assets else ASSETS_MAX_AGE)
+        kwargs = dict(song_langs=options.get('--song-langs'), langs=self.get_langs(options))
+        workers = [multiprocessing.Process(target=shard_worker, args=(shards_dir,), kwargs=kwargs)
+            for _ in range(int(options.get('--workers', "1")))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    def shard_merge(self, options):
+        shards_dir = options.get('--shard-dir', FolkDCChef.SHARDS_DATA_DIR)
+        queue = WorkQueue(os.path.join(shards_dir, "queue.sqlite"))
+        units = queue.results()
+        hash_cache.update(HashCache(os.path.join(shards_dir, "hashes.json"), root=shards_dir))
+
+        for lang, lang_units in units.items():
+            channel_tree = self.get_channel_tree(lang)
+            index = TreeIndex(channel_tree)
+            for position, result in lang_units:
+                with open(os.path.join(shards_dir, result), "r", encoding="utf8") as f:
+                    node = json.load(f)
+                if node is not None:
+                    rebase_tree_paths(node, lambda path: os.path.join(shards_dir, path))
+                    index.append(node)
+            write_tree_to_json_tree(os.path.join(FolkDCChef.TREES_DATA_DIR,
+                FolkDCChef.SCRAPING_STAGE_OUTPUT_TPL.format(lang=lang)), channel_tree)
+            index.close()
+            LOGGER.info("Merged {} units of {}".format(len(lang_units), lang))
+
+    def plan(self, args, options):
+        global plan
+        plan = Plan()
+        try:
+            for lang in self.get_langs(options):
+                plan.start_lang()
+                resources = Resource(lang=lang)
+                resources.load("resources.json")
+                for resource in resources:
+                    plan.section = (lang, resource.cls_name())
+                    base_path = build_path([MEDIA_DIR, resource.lang, resource.cls_name()])
+                    resource.to_file(base_path)
+            plan.report()
+        finally:
+            plan = None
+
     def pre_run(self, args, options):
         build_path([FolkDCChef.TREES_DATA_DIR])
-        self.download_css_js()
+        refresh_assets = bool(int(options.get('--refresh-assets', "0")))
+        app_assets.load(max_age=0 if refresh_assets else ASSETS_MAX_AGE)
         self.lang = options.get('--lang', "en")
         self.RICECOOKER_JSON_TREE = FolkDCChef.SCRAPING_STAGE_OUTPUT_TPL.format(lang=self.lang)
         self.scrape_stage = os.path.join(FolkDCChef.TREES_DATA_DIR, 
             self.RICECOOKER_JSON_TREE)
-        channel_tree = self.scrape(args, options)
-        self.write_tree_to_json(channel_tree)
-
-    def download_css_js(self):
-        r = requests.get("https://raw.githubusercontent.com/learningequality/html-app-starter/master/css/styles.css")
-        with open("chefdata/styles.css", "wb") as f:
-            f.write(r.content)
-
-        r = requests.get("https://raw.githubusercontent.com/learningequality/html-app-starter/master/js/scripts.js")
-        with open("chefdata/scripts.js", "wb") as f:
-            f.write(r.content)
-
-    def scrape(self, args, options):
-        run_test = bool(int(options.get('--test', "0")))
-
-        global channel_tree
-        channel_tree = dict(
+        if options.get('--shard') == "merge":
+            # the merged tree of --lang is uploaded as usual
+            self.shard_merge(options)
+        else:
+            if bool(int(options.get('--changes', "0"))):
+                site_changes.load(FolkDCChef.BASE_URL, options.get('--sitemap'))
+            channel_tree = self.scrape(args, options)
+            # in low memory mode the tree is already written by scrape
+            if channel_tree is not None:
+                self.write_tree_to_json(channel_tree)
+            site_changes.commit()
+            if site_changes.enabled:
+                LOGGER.info("Unchanged pages not fetched: {}, resources not built: {}".format(
+                    site_changes.hits, site_changes.tree_hits))
+        if GENERATE_THUMBNAILS is True:
+            self.add_thumbnails()
+        self.hash_tree_files()
+
+    def add_thumbnails(self):
+        with open(self.scrape_stage, "r", encoding="utf8") as f:
+            tree = json.load(f)
+        generate_thumbnails(tree, build_path([DATA_DIR, DATA_DIR_SUBJECT, "thumbnails"]))
+        write_tree_to_json_tree(self.scrape_stage, tree)
+
+    def hash_tree_files(self):
+        with open(self.scrape_stage, "r", encoding="utf8") as f:
+            tree = json.load(f)
+        paths = [path for path in get_tree_paths(tree) if file_exists(path)]
+        misses = hash_cache.hash_files(paths, workers=HASH_WORKERS)
+        hash_cache.save()
+        install_hash_cache()
+        LOGGER.info("Hashed {} of {} files".format(misses, len(paths)))
+
+    def get_channel_tree(self, lang):
+        return dict(
                 source_domain=FolkDCChef.BASE_URL,
-                source_id=CHANNEL_SOURCE_ID + "-" + self.lang,
-                title="{} ({})".format(CHANNEL_NAME, self.lang),
+                source_id=CHANNEL_SOURCE_ID + "-" + lang,
+                title="{} ({})".format(CHANNEL_NAME, lang),
                 description="""Digital Children's Folksongs for Language and Cultural Learning: a collection of multi-language folk songs and activities for primary students to learn languages, engage in collaboration and critical thinking, and develop intercultural skills. Contains folk songs, activity suggestions, and teacher training materials."""
 [:400], #400 UPPER LIMIT characters allowed 
                 thumbnail=CHANNEL_THUMBNAIL,
                 author=AUTHOR,
-                language=self.lang,
+                language=lang,
                 children=[],
                 license=LICENSE,
             )
 
+    def scrape(self, args, options):
+        run_test = bool(int(options.get('--test', "0")))
+        low_memory = bool(int(options.get('--lowmem', "0")))
+
+        global channel_tree
+        channel_tree = self.get_channel_tree(self.lang)
+
+        if getattr(self, "tree_index", None) is not None:
+            self.tree_index.close()
+        # the low memory mode writes the nodes out, only their paths are kept
+        self.tree_index = TreeIndex(channel_tree, keep_nodes=not low_memory)
+        # what the resources are built with besides their pages
+        with open("resources.json", "rb") as f:
+            self.build_config = (hashlib.sha1(f.read()).hexdigest(),
+                [app_assets.manifest.get(name, {}).get("sha1") for name in AppAssets.ASSETS],
+                SONG_LANGS.get(self.lang))
         if run_test is True:
             return test(channel_tree)
+        elif low_memory is True:
+            self.scrape_low_memory(channel_tree)
         else:
             resources = Resource(lang=self.lang)
             resources.load("resources.json")
             for resource in resources:
-                base_path = build_path([DATA_DIR, resource.lang, resource.cls_name()])
-                resource.to_file(base_path)
-                node = resource.to_dict()
+                node = self.build_resource(resource)
                 if node is not None:
-                    channel_tree["children"].append(node)
+                    self.tree_index.append(node)
+            LOGGER.info("Page cache: {} hits, {} misses".format(
+                page_cache.hits, page_cache.misses))
             return channel_tree
 
+    def scrape_low_memory(self, channel_tree):
+        tracemalloc.start()
+        # the pages of a resource are not kept until it is finished, each soup
+        # goes with the node that released it
+        page_cache.resize(LOW_MEMORY_PAGE_CACHE_SIZE)
+        resources = Resource(lang=self.lang)
+        resources.load("resources.json")
+        with JsonTreeWriter(self.scrape_stage, channel_tree) as writer:
+            for resource in resources:
+                node = self.build_resource(resource)
+                resource.release()
+                page_cache.clear()
+                if node is not None:
+                    writer.write_node(node)
+                    self.tree_index.add(node)
+                node = None
+                current, peak = tracemalloc.get_traced_memory()
+                LOGGER.info("Memory after {}: {:.1f} MB traced, {:.1f} MB peak".format(
+                    resource.title, current / 2**20, peak / 2**20))
+        page_cache.resize(PAGE_CACHE_MAX_SIZE)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        peak_rss = get_peak_rss()
+        LOGGER.info("Memory: {:.1f} MB traced peak, {} peak RSS".format(peak / 2**20,
+            "{:.1f} MB".format(peak_rss / 2**20) if peak_rss is not None else "unknown"))
+
+    def build_resource(self, resource):
+        # with --changes, a resource whose pages did not change since the last
+        # run is not built again, neither its pages nor its media are fetched
+        key = (resource.lang, resource.cls_name(), resource.source_id, self.build_config)
+        node = site_changes.get_tree(key)
+        if node is not None:
+            LOGGER.info("Unchanged: {}".format(resource.title))
+            return node
+        base_path = build_path([MEDIA_DIR, resource.lang, resource.cls_name()])
+        site_changes.visited = {}
+        try:
+            resource.to_file(base_path)
+            node = resource.to_dict()
+        finally:
+            pages, site_changes.visited = site_changes.visited, None
+        site_changes.set_tree(key, node, pages)
+        return node
+
     def write_tree_to_json(self, channel_tree):
         write_tree_to_json_tree(self.scrape_stage, channel_tree)
 
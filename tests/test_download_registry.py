@@ -0,0 +1,85 @@
+import threading
+import time
+import unittest
+
+from utils import DownloadRegistry
+
+
+class DownloadRegistryTest(unittest.TestCase):
+    def test_fetches_each_key_once(self):
+        registry = DownloadRegistry()
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            return "chefdata/a.pdf"
+
+        self.assertEqual(registry.get_or_download(("File", "u"), fetch), "chefdata/a.pdf")
+        self.assertEqual(registry.get_or_download(("File", "u"), fetch), "chefdata/a.pdf")
+        self.assertEqual(len(calls), 1)
+        self.assertIn(("File", "u"), registry)
+
+    def test_failed_fetch_is_retried(self):
+        registry = DownloadRegistry()
+        results = [None, "chefdata/a.mp3"]
+        self.assertIsNone(registry.get_or_download("u", lambda: results.pop(0)))
+        self.assertNotIn("u", registry)
+        self.assertEqual(registry.get_or_download("u", lambda: results.pop(0)), "chefdata/a.mp3")
+
+    def test_exception_is_not_kept(self):
+        registry = DownloadRegistry()
+
+        def fail():
+            raise IOError("connection reset")
+
+        with self.assertRaises(IOError):
+            registry.get_or_download("u", fail)
+        self.assertEqual(registry.get_or_download("u", lambda: "chefdata/a.pdf"), "chefdata/a.pdf")
+
+    def test_waiters_retry_after_a_failure(self):
+        registry = DownloadRegistry()
+        started = threading.Event()
+        calls = []
+
+        def first():
+            calls.append("first")
+            started.set()
+            time.sleep(0.1)
+            return None
+
+        def second():
+            calls.append("second")
+            return "chefdata/a.pdf"
+
+        results = []
+        thread = threading.Thread(target=lambda: results.append(registry.get_or_download("u", first)))
+        thread.start()
+        started.wait()
+        # waits for the fetch in flight, which fails, then fetches itself
+        self.assertEqual(registry.get_or_download("u", second), "chefdata/a.pdf")
+        thread.join()
+        self.assertEqual(results, [None])
+        self.assertEqual(calls, ["first", "second"])
+
+    def test_concurrent_requesters_share_one_fetch(self):
+        registry = DownloadRegistry()
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            time.sleep(0.05)
+            return "chefdata/a.pdf"
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(registry.get_or_download("u", fetch)))
+            for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ["chefdata/a.pdf"] * 8)
+        self.assertEqual(len(calls), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,25 @@
+import unittest
+
+from utils import normalize_heading
+
+
+class NormalizeHeadingTest(unittest.TestCase):
+    def test_case_and_spaces(self):
+        self.assertEqual(normalize_heading(" LANGUAGE  Activities\n"), "language activities")
+
+    def test_turkish_dotted_capital_i(self):
+        for text in ("DİL AKTİVİTELERİ", "Dil Aktiviteleri", "DIL AKTIVITELERI"):
+            self.assertEqual(normalize_heading(text), "dil aktiviteleri")
+        self.assertEqual(normalize_heading("KÜLTÜREL AKTİVİTELER"),
+            normalize_heading("Kültürel Aktiviteler"))
+        self.assertNotIn("\u0307", normalize_heading("MÜZİK AKTİVİTELERİ"))
+
+    def test_composed_letters_are_kept(self):
+        self.assertEqual(normalize_heading("ACTIVITĂȚI"), "activități")
+        self.assertEqual(normalize_heading("Ż"), "ż")
+        self.assertEqual(normalize_heading("Sprachliche Aktivitäten"),
+            "sprachliche aktivitäten")
+
+
+if __name__ == '__main__':
+    unittest.main()
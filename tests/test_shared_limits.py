@@ -0,0 +1,85 @@
+import multiprocessing
+import os
+import tempfile
+import time
+import unittest
+
+from utils import HashCache, PoliteSession, SharedTokenBucket
+
+
+def take_tokens(path, count):
+    bucket = SharedTokenBucket(path, "folkdc.eu", rate=20, capacity=1)
+    for _ in range(count):
+        bucket.take(1)
+
+
+class SharedTokenBucketTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "queue.sqlite")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_processes_share_the_rate(self):
+        start = time.time()
+        processes = [multiprocessing.Process(target=take_tokens, args=(self.path, 5))
+            for _ in range(2)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        # 10 tokens at 20 per second, the first one from the full bucket
+        self.assertGreaterEqual(time.time() - start, 9 / 20.0)
+        self.assertEqual([process.exitcode for process in processes], [0, 0])
+
+    def test_try_take(self):
+        bucket = SharedTokenBucket(self.path, "folkdc.eu", rate=1, capacity=2)
+        other = SharedTokenBucket(self.path, "folkdc.eu", rate=1, capacity=2)
+        self.assertEqual(bucket.try_take(1), 0)
+        self.assertEqual(other.try_take(1), 0)
+        self.assertGreater(bucket.try_take(1), 0.9)
+
+    def test_shared_session_buckets(self):
+        session = PoliteSession(None, host_limits={"folkdc.eu": dict(rate=2, burst=4)})
+        session.share(self.path)
+        queue = session.get_host("folkdc.eu")
+        self.assertIsInstance(queue.requests, SharedTokenBucket)
+        self.assertIsNone(queue.bandwidth)
+        self.assertIsNone(session.get_host("example.com").requests)
+
+
+class HashCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.tmpdir.name, "shards")
+        os.makedirs(os.path.join(self.root, "media"))
+        self.filepath = os.path.join(self.root, "media", "a.pdf")
+        with open(self.filepath, "w") as f:
+            f.write("pdf")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_keys_relative_to_root(self):
+        cache = HashCache(os.path.join(self.root, "hashes.json"), root=self.root)
+        cache.set(self.filepath, "md5")
+        cache.save()
+        self.assertEqual(list(HashCache(cache.path).hashes.keys()),
+            [os.path.join("media", "a.pdf")])
+        self.assertEqual(HashCache(cache.path, root=self.root).get(self.filepath), "md5")
+
+    def test_update_from_a_moved_root(self):
+        cache = HashCache(os.path.join(self.root, "hashes.json"), root=self.root)
+        cache.set(self.filepath, "md5")
+        cache.save()
+        # the merge host mounts the shared directory somewhere else
+        moved = os.path.join(self.tmpdir.name, "mnt")
+        os.rename(self.root, moved)
+        merged = HashCache(os.path.join(self.tmpdir.name, "hashes.json"))
+        merged.update(HashCache(os.path.join(moved, "hashes.json"), root=moved))
+        self.assertEqual(merged.get(os.path.join(moved, "media", "a.pdf")), "md5")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import os
+import tempfile
+import time
+import unittest
+
+from utils import WorkQueue
+
+
+class WorkQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "queue.sqlite")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_claims_in_queue_order_once(self):
+        queue = WorkQueue(self.path)
+        queue.put("en", "Songs", 0)
+        queue.put("en", "Activities", 1)
+        self.assertEqual(queue.claim("a")[1:], ("en", "Songs", 0))
+        self.assertEqual(queue.claim("b")[1:], ("en", "Activities", 1))
+        self.assertIsNone(queue.claim("c"))
+
+    def test_expired_lease_is_claimed_again(self):
+        queue = WorkQueue(self.path, lease=60)
+        queue.put("en", "Songs", 0)
+        unit_id = queue.claim("a")[0]
+        self.assertIsNone(queue.claim("b"))
+        with queue.connect() as conn:
+            conn.execute("UPDATE units SET started = ? WHERE id = ?", (time.time() - 61, unit_id))
+        self.assertEqual(queue.claim("b")[0], unit_id)
+
+    def test_done_and_failed_units_are_not_claimed(self):
+        queue = WorkQueue(self.path, lease=0)
+        queue.put("en", "Songs", 0)
+        queue.put("en", "Activities", 1)
+        queue.complete(queue.claim("a")[0], "en/000_Songs.json")
+        queue.fail(queue.claim("a")[0], "timeout")
+        self.assertIsNone(queue.claim("b"))
+
+    def test_results_in_position_order(self):
+        queue = WorkQueue(self.path)
+        for lang, section, position in [("en", "Activities", 1), ("it", "Songs", 0), ("en", "Songs", 0)]:
+            queue.put(lang, section, position)
+        # completed in another order than queued
+        claimed = [queue.claim("a") for _ in range(3)]
+        for unit_id, lang, section, position in reversed(claimed):
+            queue.complete(unit_id, "{}/{:03d}_{}.json".format(lang, position, section))
+        results = queue.results()
+        self.assertEqual(list(results.keys()), ["en", "it"])
+        self.assertEqual(results["en"], [(0, "en/000_Songs.json"), (1, "en/001_Activities.json")])
+        self.assertEqual(results["it"], [(0, "it/000_Songs.json")])
+
+    def test_results_need_every_unit_done(self):
+        queue = WorkQueue(self.path)
+        queue.put("en", "Songs", 0)
+        queue.put("en", "Activities", 1)
+        queue.complete(queue.claim("a")[0], "en/000_Songs.json")
+        with self.assertRaises(RuntimeError):
+            queue.results()
+
+    def test_queued_again_replaces_the_unit(self):
+        queue = WorkQueue(self.path)
+        queue.put("en", "Songs", 0)
+        queue.complete(queue.claim("a")[0], "en/000_Songs.json")
+        queue.put("en", "Songs", 0)
+        self.assertEqual(queue.claim("b")[1:], ("en", "Songs", 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,18 @@
-from git import Repo
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import heapq
+import itertools
+import json
 import ntpath
 import os
 from pathlib import Path
-from bs4 import Tag
+import sqlite3
+import sys
+import threading
+import time
+import unicodedata
+from urllib.parse import urlparse, urlunparse
 
 
 def dir_exists(filepath):
@@ -54,6 +64,7 @@ def get_name_from_url_no_ext(url):
 
 
 def clone_repo(git_url, repo_dir):
+    from git import Repo
     if not dir_exists(repo_dir):
         print("Cloning repository {}".format(git_url))
         Repo.clone_from(git_url, repo_dir)
@@ -84,7 +95,121 @@ def get_video_resolution_format(video, maxvres=720, ext="mp4"):
         return best
 
 
-def get_node_from_channel(source_id, channel_tree, exclude=None):
+# Index over a json channel tree (source_id -> node, parent and path), the
+# subtrees are indexed when they are attached so updates cost only their size.
+# Without keep_nodes only the paths are kept, the nodes can be released once
+# they are written (low memory mode).
+class TreeIndex(object):
+    # the index of each root, used by get_node_from_channel and get_level_map
+    registry = {}
+
+    def __init__(self, tree=None, keep_nodes=True):
+        self.root = None
+        self.keep_nodes = keep_nodes
+        self.nodes = {}
+        self.ancestors = {}
+        self.paths = {}
+        self.levels = {}
+        self.attached = 0
+        if tree is not None:
+            self.set_root(tree)
+
+    @classmethod
+    def of(cls, tree):
+        # None for a tree that is not indexed, the lookups search it instead
+        index = cls.registry.get(id(tree))
+        if index is None or index.root is not tree:
+            return None
+        if index.keep_nodes and index.attached != len(tree.get("children") or []):
+            # children were attached without the index
+            index.set_root(tree)
+        return index
+
+    def set_root(self, tree):
+        self.close()
+        self.root = tree
+        TreeIndex.registry[id(tree)] = self
+        self.nodes.clear()
+        self.ancestors.clear()
+        self.paths.clear()
+        self.levels.clear()
+        self.attached = 0
+        for children in tree.get("children") or []:
+            self.add(children)
+
+    def close(self):
+        if self.root is not None and TreeIndex.registry.get(id(self.root)) is self:
+            del TreeIndex.registry[id(self.root)]
+
+    def _index(self, node, parent_path, ancestors):
+        if node is None:
+            return
+        source_id = node["source_id"]
+        path = parent_path + (source_id,)
+        # keep the shallowest match like the breadth-first lookup did
+        if source_id not in self.paths or len(path) < len(self.paths[source_id]):
+            self.paths[source_id] = path
+            if self.keep_nodes:
+                self.nodes[source_id] = node
+                self.ancestors[source_id] = ancestors
+        # get_level_map follows the first child with each source_id
+        if self.keep_nodes and path not in self.levels and\
+                (len(ancestors) == 0 or self.levels.get(parent_path) is ancestors[-1]):
+            self.levels[path] = node
+        if self.keep_nodes:
+            ancestors = ancestors + (node,)
+        for children in node.get("children") or []:
+            self._index(children, path, ancestors)
+
+    def add(self, node, parent=None):
+        if parent is None or parent is self.root:
+            self.attached += 1
+            self._index(node, (), ())
+        else:
+            source_id = parent["source_id"]
+            ancestors = self.ancestors.get(source_id, ()) + (parent,) if self.keep_nodes else ()
+            self._index(node, self.paths[source_id], ancestors)
+
+    def append(self, node, parent=None):
+        if parent is None:
+            parent = self.root
+        if parent.get("children") is None:
+            parent["children"] = []
+        parent["children"].append(node)
+        self.add(node, parent=parent)
+
+    def get(self, source_id):
+        return self.nodes.get(source_id)
+
+    def get_parent(self, source_id):
+        if source_id not in self.nodes:
+            return None
+        ancestors = self.ancestors[source_id]
+        return ancestors[-1] if ancestors else self.root
+
+    def get_path(self, source_id):
+        return list(self.paths.get(source_id, ()))
+
+    def get_level(self, levels):
+        return self.levels.get(tuple(levels))
+
+    def is_under(self, source_id, title):
+        return any(node.get("title") == title for node in self.ancestors.get(source_id, ()))
+
+    def __contains__(self, source_id):
+        return source_id in self.paths
+
+    def __len__(self):
+        return len(self.paths)
+
+
+def get_node_from_channel(source_id, channel_tree, exclude=None, index=None):
+    if index is None:
+        index = TreeIndex.of(channel_tree)
+    if index is not None and index.keep_nodes:
+        node = index.get(source_id)
+        if node is None or exclude is None or not index.is_under(source_id, exclude):
+            return node
     parent = channel_tree["children"]
     while len(parent) > 0:
         for children in parent:
@@ -100,7 +225,11 @@ def get_node_from_channel(source_id, channel_tree, exclude=None):
         parent = nparent
 
 
-def get_level_map(tree, levels):
+def get_level_map(tree, levels, index=None):
+    if index is None:
+        index = TreeIndex.of(tree)
+    if index is not None and index.keep_nodes:
+        return index.get_level(levels)
     actual_node = levels[0]
     r_levels = levels[1:]
     for children in tree.get("children", []):
@@ -133,8 +262,16 @@ def save_response_content(response, destination):
                 f.flush()
 
 
+def normalize_heading(text):
+    text = unicodedata.normalize("NFKC", text).casefold()
+    # casefold() turns the Turkish capital İ into i and a combining dot above
+    text = unicodedata.normalize("NFKC", text).replace("\u0307", "")
+    return " ".join(text.split())
+
+
 def link_to_text(content):
     if content is not None:
+        from bs4 import Tag
         for tag in content.find_all("a"):
             span = Tag(name="span")
             if tag.get("href", ""):
@@ -144,3 +281,554 @@ def link_to_text(content):
                 elif url.startswith("http") or url.startswith("/"):
                     tag.wrap(span)
                     span.insert(1, " ("+url+")")
+
+
+def normalize_url(url):
+    url = url.strip()
+    parsed = urlparse(url)
+    scheme = parsed.scheme.lower()
+    netloc = parsed.netloc.lower()
+    if (scheme == "http" and netloc.endswith(":80")) or\
+            (scheme == "https" and netloc.endswith(":443")):
+        netloc = netloc.rsplit(":", 1)[0]
+    path = parsed.path or "/"
+    return urlunparse((scheme, netloc, path, parsed.params, parsed.query, ""))
+
+
+# LRU cache bounded by the sum of the sizes given for each value, the caller
+# decides what the size measures
+class PageCache(object):
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.items = OrderedDict()
+
+    def get(self, key):
+        try:
+            value, size = self.items[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, size):
+        if key in self.items:
+            self.size -= self.items.pop(key)[1]
+        if size > self.max_size:
+            return
+        self.items[key] = (value, size)
+        self.size += size
+        self.evict()
+
+    def resize(self, max_size):
+        self.max_size = max_size
+        self.evict()
+
+    def evict(self):
+        while self.size > self.max_size:
+            _, (_, old_size) = self.items.popitem(last=False)
+            self.size -= old_size
+
+    def clear(self):
+        self.items.clear()
+        self.size = 0
+
+    def __len__(self):
+        return len(self.items)
+
+
+# Run scoped registry of downloads, each key is fetched once and concurrent
+# requesters wait for the fetch in flight. Failed fetches (None) are not
+# kept, the next requester tries again.
+class DownloadRegistry(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.results = {}
+        self.pending = {}
+
+    def get_or_download(self, key, fn):
+        while True:
+            with self.lock:
+                if key in self.results:
+                    return self.results[key]
+                event = self.pending.get(key)
+                if event is None:
+                    event = threading.Event()
+                    self.pending[key] = event
+                    break
+            event.wait()
+
+        result = None
+        try:
+            result = fn()
+        finally:
+            with self.lock:
+                if result is not None:
+                    self.results[key] = result
+                del self.pending[key]
+            event.set()
+        return result
+
+    def clear(self):
+        with self.lock:
+            self.results.clear()
+
+    def __contains__(self, key):
+        return key in self.results
+
+    def __len__(self):
+        return len(self.results)
+
+
+# Writes a json tree in the format of write_tree_to_json_tree, streaming the
+# top level children to disk as they are finished
+class JsonTreeWriter(object):
+    def __init__(self, destpath, tree):
+        self.destpath = destpath
+        self.tmppath = destpath + ".tmp"
+        self.tree = OrderedDict((k, v) for k, v in tree.items() if k != "children")
+        self.count = 0
+        self.file = None
+
+    def __enter__(self):
+        parent_dir = os.path.dirname(self.destpath)
+        if parent_dir:
+            os.makedirs(parent_dir, exist_ok=True)
+        self.file = open(self.tmppath, "w", encoding="utf8")
+        header = json.dumps(self.tree, indent=2, ensure_ascii=False)
+        # the header without its closing brace, "{" for an empty tree
+        self.file.write(header.rstrip()[:-1].rstrip())
+        self.file.write(',\n  "children": [' if self.tree else '\n  "children": [')
+        return self
+
+    def write_node(self, node):
+        content = json.dumps(node, indent=2, ensure_ascii=False)
+        self.file.write(",\n    " if self.count > 0 else "\n    ")
+        self.file.write(content.replace("\n", "\n    "))
+        self.file.flush()
+        self.count += 1
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.file.write("\n  ]\n}" if self.count > 0 else "]\n}")
+            self.file.close()
+            os.replace(self.tmppath, self.destpath)
+        else:
+            self.file.close()
+            os.remove(self.tmppath)
+        return False
+
+
+def get_peak_rss():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macOS bytes
+    if sys.platform == "darwin":
+        return peak
+    return peak * 1024
+
+
+class TokenBucket(object):
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(rate, 1))
+        self.tokens = self.capacity
+        self.timestamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+        self.timestamp = now
+
+    def delay(self, amount=1):
+        with self.lock:
+            self._refill()
+            need = min(amount, self.capacity) - self.tokens
+            return max(0, need / self.rate)
+
+    def consume(self, amount=1):
+        with self.lock:
+            self._refill()
+            self.tokens -= amount
+
+    def try_take(self, amount=1):
+        # takes the tokens and returns 0, or the seconds to wait for them
+        with self.lock:
+            self._refill()
+            need = min(amount, self.capacity) - self.tokens
+            if need <= 0:
+                self.tokens -= amount
+                return 0
+            return need / self.rate
+
+    def take(self, amount=1):
+        # amounts bigger than the capacity leave the bucket in debt
+        while True:
+            wait = self.try_take(amount)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+
+# A TokenBucket kept in a sqlite database, the processes using the same
+# database and name share its rate, e.g. the shard workers on every host
+class SharedTokenBucket(TokenBucket):
+    def __init__(self, path, name, rate, capacity=None):
+        super(SharedTokenBucket, self).__init__(rate, capacity)
+        self.path = path
+        self.name = name
+        with self.connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS buckets (
+                name TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                timestamp REAL NOT NULL)""")
+            conn.execute("INSERT OR IGNORE INTO buckets VALUES (?, ?, ?)",
+                (name, self.capacity, time.time()))
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        return ClosingConnection(conn)
+
+    def update(self, fn):
+        # fn gets the refilled tokens and returns (tokens, result)
+        with self.lock, self.connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            tokens, timestamp = conn.execute("SELECT tokens, timestamp FROM buckets WHERE name = ?",
+                (self.name,)).fetchone()
+            # wall clock, shared by the processes, never goes back
+            now = max(time.time(), timestamp)
+            tokens, result = fn(min(self.capacity, tokens + (now - timestamp) * self.rate))
+            conn.execute("UPDATE buckets SET tokens = ?, timestamp = ? WHERE name = ?",
+                (tokens, now, self.name))
+            conn.execute("COMMIT")
+            return result
+
+    def delay(self, amount=1):
+        return self.update(lambda tokens: (tokens,
+            max(0, (min(amount, self.capacity) - tokens) / self.rate)))
+
+    def consume(self, amount=1):
+        self.update(lambda tokens: (tokens - amount, None))
+
+    def try_take(self, amount=1):
+        def take(tokens):
+            need = min(amount, self.capacity) - tokens
+            if need <= 0:
+                return tokens - amount, 0
+            return tokens, need / self.rate
+        return self.update(take)
+
+
+# Requests waiting for a host are released by the token bucket, smallest
+# expected transfer first
+class HostQueue(object):
+    def __init__(self, requests=None, bandwidth=None):
+        self.requests = requests
+        self.bandwidth = bandwidth
+        self.cond = threading.Condition()
+        self.waiting = []
+
+    def acquire(self, size, seq):
+        if self.requests is None:
+            return
+        job = (size, seq)
+        with self.cond:
+            heapq.heappush(self.waiting, job)
+            while True:
+                if self.waiting[0] == job:
+                    wait = self.requests.try_take(1)
+                    if wait <= 0:
+                        heapq.heappop(self.waiting)
+                        self.cond.notify_all()
+                        return
+                    self.cond.wait(wait)
+                else:
+                    self.cond.wait()
+
+
+SIZE_HINTS = {
+    "mp4": 100 * 2**20, "webm": 100 * 2**20, "mkv": 100 * 2**20,
+    "mp3": 5 * 2**20, "pdf": 2**20, "zip": 2**20,
+    "jpg": 100 * 2**10, "jpeg": 100 * 2**10, "png": 100 * 2**10, "gif": 100 * 2**10,
+}
+
+
+def guess_size(url):
+    name = get_name_from_url(urlparse(url).path)
+    ext = name.split(".")[-1].lower() if name.find(".") != -1 else ""
+    return SIZE_HINTS.get(ext, 50 * 2**10)
+
+
+# Wraps a requests session with per host rate limits, optional per host and
+# global bandwidth caps and shortest job first ordering
+class PoliteSession(object):
+    def __init__(self, session, host_limits=None, bandwidth=None):
+        self.session = session
+        self.host_limits = host_limits or {}
+        self.bandwidth_limit = bandwidth
+        self.shared = None
+        self.bandwidth = self.make_bucket("bandwidth", bandwidth)
+        self.hosts = {}
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+
+    def share(self, path):
+        # the limits are kept in the sqlite database at path, all the sessions
+        # sharing it stay within them together
+        with self.lock:
+            self.shared = path
+            self.bandwidth = self.make_bucket("bandwidth", self.bandwidth_limit)
+            self.hosts = {}
+
+    def make_bucket(self, name, rate, capacity=None):
+        if not rate:
+            return None
+        if self.shared is None:
+            return TokenBucket(rate, capacity)
+        return SharedTokenBucket(self.shared, name, rate, capacity)
+
+    def get_limits(self, host):
+        for name, limits in self.host_limits.items():
+            if host == name or host.endswith("." + name):
+                return limits
+        return {}
+
+    def get_host(self, host):
+        with self.lock:
+            if host not in self.hosts:
+                limits = self.get_limits(host)
+                self.hosts[host] = HostQueue(
+                    self.make_bucket(host, limits.get("rate"), limits.get("burst")),
+                    self.make_bucket(host + " bandwidth", limits.get("bandwidth")))
+            return self.hosts[host]
+
+    def request(self, method, url, size=None, **kwargs):
+        queue = self.get_host(urlparse(url).hostname or "")
+        if method.upper() == "HEAD":
+            size = 0
+        elif size is None:
+            size = guess_size(url)
+        queue.acquire(size, next(self.counter))
+        response = self.session.request(method, url, **kwargs)
+
+        buckets = [b for b in (queue.bandwidth, self.bandwidth) if b is not None]
+        if len(buckets) > 0 and method.upper() != "HEAD":
+            if kwargs.get("stream", False):
+                self.throttle(response, buckets)
+            else:
+                for bucket in buckets:
+                    bucket.take(len(response.content))
+        return response
+
+    def throttle(self, response, buckets):
+        iter_content = response.iter_content
+
+        def throttled(chunk_size=1, decode_unicode=False):
+            for chunk in iter_content(chunk_size, decode_unicode):
+                for bucket in buckets:
+                    bucket.take(len(chunk))
+                yield chunk
+        response.iter_content = throttled
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault("allow_redirects", True)
+        return self.request("GET", url, **kwargs)
+
+    def head(self, url, **kwargs):
+        kwargs.setdefault("allow_redirects", False)
+        return self.request("HEAD", url, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+
+# Sqlite backed queue of work units, it can be shared by worker processes on
+# several hosts through a common filesystem. Units claimed by a worker that
+# did not finish them within lease seconds are handed out again.
+class WorkQueue(object):
+    def __init__(self, path, lease=6 * 60 * 60):
+        self.path = path
+        self.lease = lease
+        with self.connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS units (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                lang TEXT NOT NULL,
+                section TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                worker TEXT,
+                started REAL,
+                result TEXT,
+                error TEXT,
+                UNIQUE (lang, position))""")
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        return ClosingConnection(conn)
+
+    def put(self, lang, section, position):
+        with self.connect() as conn:
+            conn.execute("""INSERT OR REPLACE INTO units (lang, section, position)
+                VALUES (?, ?, ?)""", (lang, section, position))
+
+    def claim(self, worker):
+        with self.connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("""SELECT id, lang, section, position FROM units
+                WHERE status = 'pending' OR (status = 'running' AND started < ?)
+                ORDER BY id LIMIT 1""", (time.time() - self.lease,)).fetchone()
+            if row is not None:
+                conn.execute("""UPDATE units SET status = 'running', worker = ?,
+                    started = ? WHERE id = ?""", (worker, time.time(), row[0]))
+            conn.execute("COMMIT")
+            return row
+
+    def complete(self, unit_id, result):
+        with self.connect() as conn:
+            conn.execute("""UPDATE units SET status = 'done', result = ?, error = NULL
+                WHERE id = ?""", (result, unit_id))
+
+    def fail(self, unit_id, error):
+        with self.connect() as conn:
+            conn.execute("UPDATE units SET status = 'failed', error = ? WHERE id = ?",
+                (error, unit_id))
+
+    def units(self):
+        with self.connect() as conn:
+            return conn.execute("""SELECT id, lang, section, position, status, result
+                FROM units ORDER BY id""").fetchall()
+
+    def results(self):
+        # the results of each language in position order, once all are done
+        results = OrderedDict()
+        for unit_id, lang, section, position, status, result in self.units():
+            if status != "done":
+                raise RuntimeError("Unit {} {} of {} is {}".format(position, section, lang, status))
+            results.setdefault(lang, []).append((position, result))
+        for lang_results in results.values():
+            lang_results.sort()
+        return results
+
+
+class ClosingConnection(object):
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self.conn
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and self.conn.in_transaction:
+            self.conn.execute("ROLLBACK")
+        self.conn.close()
+        return False
+
+
+def iter_tree_nodes(node):
+    if node is None:
+        return
+    yield node
+    for children in node.get("children") or []:
+        for child in iter_tree_nodes(children):
+            yield child
+
+
+def get_tree_paths(node):
+    if node is None:
+        return
+    if node.get("thumbnail") and file_exists(node["thumbnail"]):
+        yield node["thumbnail"]
+    for file_ in node.get("files") or []:
+        if file_.get("path"):
+            yield file_["path"]
+    for children in node.get("children") or []:
+        for path in get_tree_paths(children):
+            yield path
+
+
+def get_file_md5(filepath):
+    file_hash = hashlib.md5()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(2097152), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+# Persistent md5 of local files, an entry is valid while the path, size,
+# mtime and inode of the file are unchanged. The paths are absolute, or
+# relative to root when it is given.
+class HashCache(object):
+    def __init__(self, path, root=None):
+        self.path = path
+        self.root = root
+        self.lock = threading.Lock()
+        self.hashes = {}
+        if file_exists(path):
+            with open(path, "r") as f:
+                self.hashes = json.load(f)
+
+    def stat_key(self, filepath):
+        stat = os.stat(filepath)
+        return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+    def key(self, filepath):
+        if self.root is None:
+            return os.path.abspath(filepath)
+        return os.path.relpath(filepath, self.root)
+
+    def filepath(self, key):
+        if self.root is None:
+            return key
+        return os.path.abspath(os.path.join(self.root, key))
+
+    def get(self, filepath):
+        entry = self.hashes.get(self.key(filepath))
+        try:
+            if entry is not None and entry[:3] == self.stat_key(filepath):
+                return entry[3]
+        except FileNotFoundError:
+            pass
+        return None
+
+    def set(self, filepath, md5):
+        with self.lock:
+            self.hashes[self.key(filepath)] = self.stat_key(filepath) + [md5]
+
+    def hash_file(self, filepath):
+        md5 = get_file_md5(filepath)
+        self.set(filepath, md5)
+        return md5
+
+    def hash_files(self, filepaths, workers=4):
+        misses = [path for path in OrderedDict.fromkeys(filepaths) if self.get(path) is None]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(self.hash_file, misses))
+        return len(misses)
+
+    def update(self, other):
+        with self.lock:
+            for key, entry in other.hashes.items():
+                self.hashes[self.key(other.filepath(key))] = entry
+
+    def save(self):
+        # several shard workers can save the same file, keep the entries the
+        # others wrote since this cache was loaded
+        tmppath = "{}.{}.tmp".format(self.path, os.getpid())
+        with self.lock:
+            hashes = {}
+            if file_exists(self.path):
+                with open(self.path, "r") as f:
+                    hashes = json.load(f)
+            hashes.update(self.hashes)
+            self.hashes = hashes
+            with open(tmppath, "w") as f:
+                json.dump(self.hashes, f)
+            os.replace(tmppath, self.path)